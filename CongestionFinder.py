@@ -10,16 +10,17 @@
 
     This program finds instances of interdomain congestion in the given number of preceeding months between
     network-ASN pairs, and outputs the resulting time period, congestion measurement and visualization links
-    to a .xls file in a new directory titled 'congestion' followed by the date and time of the program's
+    to a .xlsx file in a new directory titled 'congestion' followed by the date and time of the program's
     execution.
 
     The number of preceeding months the search is conducted on can be changed by altering
     the MONTHS variable. The difference between the start and end dates can be a maximum of 30 days, so the
-    final result is constructed by parsing as many queries as there are months.
+    final result is constructed by parsing as many queries as there are months. If the API accepts a wider
+    window (checked once at startup), each query spans WIDE_SLICE_DAYS instead, and fewer queries are made.
 
     The program uses the input to contruct a query for the /asrt method in the MANIC API. The result is parsed
     to find instances of nonzero congestion. It also creates an appropriate URL to the MANIC visualization tool,
-    which can be found in the .xls file titled with network name. Each sheet in .xls file refers to an ASN that
+    which can be found in the .xlsx file titled with network name. Each sheet in .xlsx file refers to an ASN that
     the network is associated with. If no instances of congestion are found, the file is not saved.
 
     Two visualization links per detected instance of congestion are generated. One link specifies day-level
@@ -27,47 +28,123 @@
     month level granularity, displaying the visualizaion of the month surrounding the instance (15 days prior
     to and following instance).
     
-    The .xls file is manipulated using the xlwt library [pip install xlwt].
+    The .xlsx file is written using the xlsxwriter library [pip install xlsxwriter].
+    The MANIC API is queried concurrently using the httpx library [pip install httpx].
+    Responses are parsed using the orjson library if it is installed [pip install orjson].
+    Responses for past time periods are cached in '.manic_cache' using the diskcache library [pip install diskcache].
+    The query windows are aligned to fixed dates, so running the program again only queries the MANIC API for the
+    windows covering the most recent days.
     The names of the network-ASN pairs are generated by calling the /monitors method of the MANIC API.
 '''
 
 
-import json
-import urllib.request
-import urllib
+import asyncio
+import diskcache
+import hashlib
+import httpx
 import sys
 import pprint
 import datetime
-import xlwt
-from xlwt import Workbook
+import math
+import xlsxwriter
 import time
 import os
 
+# orjson parses the raw response bytes directly and is considerably faster, but is optional
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 MONTHS = 60
 
+# Number of days spanned by each /asrt query. 30 days is always accepted, a wider window is used if the API allows it
+SLICE_DAYS = 30
+WIDE_SLICE_DAYS = 90
+
+# Fixed date the /asrt windows are aligned to, so that past windows are queried with the same dates on every run
+WINDOW_EPOCH = datetime.date(2000, 1, 1)
+
+# Maximum number of simultaneous connections to the MANIC API
+MAX_CONNECTIONS = 32
+
+# Maximum number of networks processed at the same time
+MAX_NETWORKS = 8
+
+# Settings for the shared connection pool to the MANIC API
+HEADERS = {"Accept": "application/json"}
+TIMEOUT = 30
+RETRIES = 3
 
-def get_result(url: str) -> 'json':
+# Lookups of ASN names from the MANIC API, in "ASN":task format. Storing the task rather than the name means
+# networks processed at the same time share a single lookup that is still in flight
+ASN_NAMES = {}
+
+# Responses for past /asrt windows never change, so they are kept on disk and shared across runs. The cache
+# lives next to the 'congestion' directories rather than inside them.
+CACHE = diskcache.Cache(os.path.abspath('.manic_cache'))
+# Number of days an /asrt window must have ended before its response is cached
+CACHE_AFTER_DAYS = 2
+
+
+async def get_result(client: httpx.AsyncClient, url: str, cacheable: bool = False) -> 'json':
     '''
     Returns JSON response at supplied url, or exits program if a HTTP error is encountered.
+
+    If 'cacheable' is set, the response is read from and stored in the on-disk cache.
     '''
+    key = hashlib.blake2b(url.encode(), digest_size = 16).hexdigest()
+    if cacheable and key in CACHE:
+        return CACHE[key]
     try:
-        response = urllib.request.urlopen(url)
-        json_text = response.read().decode(encoding = 'utf-8')
-        return json.loads(json_text)
-    except urllib.error.HTTPError as err:
-        if err.code == 500:
+        response = await client.get(url)
+        response.raise_for_status()
+        result = json_loads(response.content)
+        if cacheable:
+            CACHE[key] = result
+        return result
+    except httpx.HTTPStatusError as err:
+        if err.response.status_code == 500:
             print('Internal Server Error: The server did not respond')
             sys.exit()
-        elif err.code == 400:
+        elif err.response.status_code == 400:
             print('Parameter Error: Invalid input')
             sys.exit()
         else:
-            print('ERROR CODE: ' + str(err.code))
+            print('ERROR CODE: ' + str(err.response.status_code))
             sys.exit()
     return ""
 
 
+async def get_asn_name(client: httpx.AsyncClient, asn: str) -> str:
+    '''
+    Returns the name of the ASN using the /asns method. Each ASN is only looked up once per run.
+    '''
+    if asn not in ASN_NAMES:
+        ASN_URL = "https://api.manic.caida.org/v1/asns/{}?verbose=true".format(asn)
+        ASN_NAMES[asn] = asyncio.ensure_future(get_result(client, ASN_URL))
+    return (await ASN_NAMES[asn])['data']['name']
+
+
+async def get_slice_days(client: httpx.AsyncClient, near_asn: str, far_asn: str) -> int:
+    '''
+    Returns the number of days each /asrt query can span. A single query with a wider window is tried once,
+    falling back to 30 day slices if it is rejected by the MANIC API.
+    '''
+    end = datetime.date.today()
+    start = end - datetime.timedelta(days = WIDE_SLICE_DAYS)
+    PROBE_URL = "https://api.manic.caida.org/v1/asrt?near_org_asn={}&far_asn={}&start={}&end={}".format(
+        near_asn, far_asn, start.strftime("%Y%m%d"), end.strftime("%Y%m%d"))
+    try:
+        response = await client.get(PROBE_URL)
+    except httpx.HTTPError:
+        return SLICE_DAYS
+    if response.status_code == 200:
+        return WIDE_SLICE_DAYS
+    return SLICE_DAYS
+
+
 class JSON_Printer(pprint.PrettyPrinter):
     def format(self, object, context, maxlevels, level) -> None:
         '''
@@ -84,93 +161,179 @@ class JSON_Printer(pprint.PrettyPrinter):
         return pprint.PrettyPrinter.format(self, object, context, maxlevels, level)
 
 
-def save_congestion(near_asn: str, far_asn: str, wb: xlwt.Workbook, near_name: str, filename: str,) -> None:
+async def get_congestion(client: httpx.AsyncClient, near_asn: str, far_asn: str, slice_days: int) -> tuple:
     '''
-    Constructs /asrt query and visualization URL and fetches JSON data, before outputting to appropriate .xls file.
+    Constructs /asrt queries spanning slice_days each and fetches them concurrently, along with the name of the far ASN.
+    Returns the far ASN name and the list of JSON results in chronological order.
     '''
 
-    #Base URLs for both the /asrt API query and visualization tool
+    #Base URL for the /asrt API query
     BASE_URL = "https://api.manic.caida.org/v1/asrt"
-    VIS_BASE = "https://viz.manic.caida.org/d/cmCi50Umz/all-links-from-vp-network-to-neighbor-network?orgId=2"
 
-    near_url = "?near_org_asn=" + near_asn
-    far_url = "&far_asn=" + far_asn
+    # Part of the query shared by every month
+    query_prefix = BASE_URL + "?near_org_asn=" + near_asn + "&far_asn=" + far_asn
+
+    # Get list of dates going back given number of months, each slice_days apart. The dates are aligned to
+    # multiples of slice_days from WINDOW_EPOCH, and only the last, partial window ends today
+    today = datetime.date.today()
+    last = today - datetime.timedelta(days = (today - WINDOW_EPOCH).days % slice_days)
+    times = [last - datetime.timedelta(days = slice_days * i) for i in range(math.ceil(MONTHS * 30 / slice_days) + 1)]
+    times.reverse()
+    if last != today:
+        times.append(today)
+
+    # Construct all /asrt query URLs up front, marking windows that ended long enough ago to be cached
+    urls = []
+    cache_before = today - datetime.timedelta(days = CACHE_AFTER_DAYS)
+    for i in range(len(times) - 1):
+        start_url = "&start=" + times[i].strftime("%Y%m%d")
+        end_url = "&end=" + times[i + 1].strftime("%Y%m%d")
+        urls.append((query_prefix + start_url + end_url + "&is_congested=true", times[i + 1] <= cache_before))
+
+    # Get name of the ASN using the /asns method, while fetching every month at once
+    far_name, *results = await asyncio.gather(get_asn_name(client, far_asn),
+                                              *(get_result(client, url, cacheable) for url, cacheable in urls))
+    return far_name, results
+
+
+def save_congestion(near_asn: str, far_asn: str, wb: xlsxwriter.Workbook, near_name: str, far_name: str,
+                    sheet_name: str, results: list) -> int:
+    '''
+    Constructs visualization URLs for the fetched /asrt results, before outputting to appropriate .xlsx file
+    in a sheet titled 'sheet_name'. Returns the number of instances of congestion found.
+    '''
+
+    #Base URL for the visualization tool
+    VIS_BASE = "https://viz.manic.caida.org/d/cmCi50Umz/all-links-from-vp-network-to-neighbor-network?orgId=2"
 
-    # Get name of the ASN using the /monitors method
-    FAR_MONITOR_URL = "https://api.manic.caida.org/v1/asns/{}?verbose=true".format(far_asn)
-    far_name = get_result(FAR_MONITOR_URL)['data']['name']
     print("\n\tNETWORK NAME:\t{}".format(near_name))
     print("\t    ASN NAME:\t{}".format(far_name))
-    
-    # Get list of dates going back given number of months, each 30 days apart
-    times = [datetime.datetime.now()]
-    for i in range(MONTHS):
-        new_time = times[0] - datetime.timedelta(days = 30)
-        times.insert(0, new_time)
-
-    # Creating new sheet in .xls file with appropriate column names
-    if far_asn in asns.keys():
-        far_name = asns[far_asn]
-    sheet1 = wb.add_sheet(far_name)
-    sheet1.write(0, 0, 'Time')
-    sheet1.write(0, 1, 'Congestion')
-    sheet1.write(0, 2, 'Visualization - Day Granularity')
-    sheet1.write(0, 3, 'Visualization - Month Granularity')
-    # Variables to keep track of index in .xls file
+
+    # Sheet in .xlsx file is only created once the first instance of congestion is found
+    sheet1 = None
+    # Variables to keep track of index in .xlsx file
     x_val = 0
     old_x = 0
-    for i in range(len(times) - 1):
-        
-        # Construct /asrt query URL
-        start_url = "&start=" + times[i].strftime("%Y") + times[i].strftime("%m") + times[i].strftime("%d")
-        end_url = "&end=" + times[i + 1].strftime("%Y") + times[i + 1].strftime("%m") + times[i + 1].strftime("%d")
-        QUERY_URL = BASE_URL + near_url + far_url + start_url + end_url + "&is_congested=true"
-        json_result = get_result(QUERY_URL)
 
-        network_url = "&var-network=" + near_asn
-        asn_url = "&var-asn=" + far_asn
+    # Part of the visualization URLs shared by every instance of congestion
+    vis_suffix = "&var-network=" + near_asn + "&var-asn=" + far_asn
 
-        # Write data to .xls file if applicable
+    for json_result in results:
+        # Write data to .xlsx file if applicable
         for data in json_result['data']:
+            # Skip slices without any instances of congestion
+            rows = data.get('data')
+            if not rows:
+                continue
             old_x = x_val
-            if data['data'] != []:
-                for assertions in data['data']:
-                    sheet1.write(x_val + 1, 0, str(assertions['time']))
-                    sheet1.write(x_val + 1, 1, str(assertions['congestion']))
-
-                    # Construct MANIC visualization URL for day of instance of congestion and write to .xls file
-                    day_granularity = datetime.datetime.strptime(str(assertions['time'])[0:10], '%Y-%m-%d')
-                    day_from_url = "&from=" + day_granularity.strftime("%Y") + day_granularity.strftime("%m") + day_granularity.strftime("%d")
-                    day_granularity = day_granularity + datetime.timedelta(days = 2)
-                    day_to_url = "&to=" + day_granularity.strftime("%Y") + day_granularity.strftime("%m") + day_granularity.strftime("%d")
-                    DAY_VIS_QUERY = VIS_BASE + day_from_url + day_to_url + network_url + asn_url
-                    sheet1.write(x_val + 1, 2, DAY_VIS_QUERY)
-
-                    # Construct MANIC visualization URL for month surrounding instance of congestion and write to .xls file
-                    month_granularity = datetime.datetime.strptime(str(assertions['time'])[0:10], '%Y-%m-%d')
-                    month_granularity = month_granularity - datetime.timedelta(days = 15)
-                    month_from_url = "&from=" + month_granularity.strftime("%Y") + month_granularity.strftime("%m") + month_granularity.strftime("%d")
-                    month_granularity = month_granularity + datetime.timedelta(days = 30)
-                    month_to_url = "&to=" + month_granularity.strftime("%Y") + month_granularity.strftime("%m") + month_granularity.strftime("%d")
-                    MONTH_VIS_QUERY = VIS_BASE + month_from_url + month_to_url + network_url + asn_url
-                    sheet1.write(x_val + 1, 3, MONTH_VIS_QUERY)
-                    
-                    x_val += 1
-                    #print(str(x_val) + ") " + assertions['time'] + "," + str(assertions['congestion']))
+            for assertions in rows:
+                # Creating new sheet in .xlsx file with appropriate column names
+                if sheet1 is None:
+                    sheet1 = wb.add_worksheet(sheet_name)
+                    sheet1.write_row(0, 0, ('Time', 'Congestion', 'Visualization - Day Granularity',
+                                            'Visualization - Month Granularity'))
+
+                # Date of instance of congestion, parsed once from the ISO timestamp
+                congestion_date = datetime.date.fromisoformat(str(assertions['time'])[0:10])
+
+                # Construct MANIC visualization URL for day of instance of congestion
+                day_from_url = "&from=" + congestion_date.strftime("%Y%m%d")
+                day_granularity = congestion_date + datetime.timedelta(days = 2)
+                day_to_url = "&to=" + day_granularity.strftime("%Y%m%d")
+                DAY_VIS_QUERY = VIS_BASE + day_from_url + day_to_url + vis_suffix
+
+                # Construct MANIC visualization URL for month surrounding instance of congestion
+                month_granularity = congestion_date - datetime.timedelta(days = 15)
+                month_from_url = "&from=" + month_granularity.strftime("%Y%m%d")
+                month_granularity = congestion_date + datetime.timedelta(days = 15)
+                month_to_url = "&to=" + month_granularity.strftime("%Y%m%d")
+                MONTH_VIS_QUERY = VIS_BASE + month_from_url + month_to_url + vis_suffix
+
+                # Write the whole row to .xlsx file at once
+                sheet1.write_row(x_val + 1, 0, (str(assertions['time']), str(assertions['congestion']),
+                                                DAY_VIS_QUERY, MONTH_VIS_QUERY))
+                
+                x_val += 1
+                #print(str(x_val) + ") " + assertions['time'] + "," + str(assertions['congestion']))
             #sheet1.write_merge(old_x + 1, x_val, 2, 2, VIS_QUERY)
 
         # Uncomment to see full JSON output:
         #JSON_Printer().pprint(json_result)
 
-    # File is not saved if there are no instances of congestion
     if x_val != 0:
-        wb.save(filename)
         if x_val == 1:
         	        print("\n\tRESULT: 1 instance of congestion found.")
         else:
         	print("\n\tRESULT: {:,} instances of congestion found.".format(x_val))
     else:
         print("\n\tRESULT: No instances of congestion found.");
+    return x_val
+
+
+async def process_network(client: httpx.AsyncClient, network: str, network_name: str, far_asns: dict,
+                          slice_days: int, semaphore: asyncio.Semaphore) -> None:
+    '''
+    Finds congestion between the network and all ASNs from the 'far_asns' dictionary, and saves it to a .xlsx file
+    titled with the network name. Each sheet is titled with the name of the ASN in 'far_asns'.
+
+    Everything after the /asrt results are fetched runs without yielding to the event loop, so the output of
+    networks processed at the same time is never interleaved.
+    '''
+    async with semaphore:
+        # Set internal execution start time
+        start_t = time.time()
+
+        # Get name of the network using the /asns method
+        near_name = await get_asn_name(client, network)
+
+        # Find congestion between the network and all ASNs from the 'far_asns' dictionary concurrently
+        congestion = await asyncio.gather(*(get_congestion(client, network, asn, slice_days) for asn in far_asns))
+
+        # Construct filename
+        filename = network_name + ".xlsx"
+
+        # Initialize xlsxwriter workbook, streaming each row to disk instead of keeping it in memory. Nothing is
+        # written until the first sheet is added
+        wb = xlsxwriter.Workbook(filename, {'constant_memory': True, 'strings_to_urls': False})
+
+        print("\n----------------\n\nORG NAME:\t{}".format(network_name))
+        x_val = 0
+        for asn, (far_name, results) in zip(far_asns, congestion):
+            print("\n\t----------------")
+            x_val += save_congestion(network, asn, wb, near_name, far_name, far_asns[asn], results)
+
+        # File is not saved if there are no instances of congestion
+        if x_val != 0:
+            wb.close()
+
+        # Set internal execution end time
+        end_t = time.time()
+        print("\nExecution time: {} seconds".format(str(round(end_t - start_t, 3))))
+
+
+async def main(networks: dict, asns: dict) -> None:
+    '''
+    Finds congestion between every network and all ASNs and other networks, sharing a single connection pool to
+    the MANIC API.
+
+    Connections are kept alive and reused for every request, so the TCP and TLS handshakes are only paid once
+    per connection. Failed connection attempts are retried before giving up. Up to MAX_NETWORKS networks are
+    processed at the same time.
+    '''
+    limits = httpx.Limits(max_connections = MAX_CONNECTIONS, max_keepalive_connections = MAX_CONNECTIONS)
+    transport = httpx.AsyncHTTPTransport(limits = limits, retries = RETRIES)
+    async with httpx.AsyncClient(transport = transport, headers = HEADERS, timeout = TIMEOUT) as client:
+        # Check once whether the /asrt method accepts windows wider than 30 days
+        slice_days = await get_slice_days(client, next(iter(networks)), next(iter(asns)))
+
+        # Each network is paired with all ASNs and all other networks, but not with itself
+        far_asns = {**asns, **networks}
+
+        semaphore = asyncio.Semaphore(min(MAX_NETWORKS, len(networks)))
+        await asyncio.gather(*(process_network(client, network, networks[network],
+                                               {asn: name for asn, name in far_asns.items() if asn != network},
+                                               slice_days, semaphore)
+                               for network in networks.keys()))
 
 
 if __name__ == '__main__':
@@ -210,34 +373,7 @@ if __name__ == '__main__':
         "8075"  :   'MICROSOFT',            # MICROSOFT-CORP-MSN-AS-BLOCK
         "174"   :   'CCOGENT'               # COGENT-174
     }
-    # Add all keys from networks dictionary (ASNs) to list of ASNs
-    for network in networks.keys():
-        asns.update({network: networks[network]})
-
-    for network in networks.keys():
-        # Set internal execution start time
-        start_t = time.time()
-
-        # Get name of the network using the /monitors method
-        NEAR_MONITOR_URL = "https://api.manic.caida.org/v1/asns/{}?verbose=true".format(network)
-        near_result = get_result(NEAR_MONITOR_URL)
-        near_name = near_result['data']['name']
-
-        # Construct filename
-        filename = networks[network] + ".xls"
-
-        # Initialize xlwt workbook.
-        wb = Workbook()
-
-        # Find congestion between the network and all ASNs from the 'asns' list
-        print("\n----------------\n\nORG NAME:\t{}".format(networks[network]))
-        for asn in asns:
-            print("\n\t----------------")
-            save_congestion(network, asn, wb, near_name, filename)
-
-        # Set internal execution end time
-        end_t = time.time()
-        print("\nExecution time: {} seconds".format(str(round(end_t - start_t, 3))))
+    asyncio.run(main(networks, asns))
 
     # Set end time
     end = time.time()